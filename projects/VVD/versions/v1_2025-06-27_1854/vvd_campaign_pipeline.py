@@ -1,32 +1,59 @@
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import (
-    col, sum, count, avg, max, min, 
-    datediff, current_date, date_format,
+    col, sum, count, avg, max, min, approx_count_distinct,
+    datediff, current_date, date_format, sqrt, greatest,
     when, coalesce, lit, dense_rank,
     row_number, lead, lag, months_between,
     collect_list, collect_set, size,
-    first, last, stddev, variance
+    first, last
 )
 from pyspark.sql.window import Window
 from pyspark.sql.types import *
 import datetime
 
+
+def format_rows(rows):
+    """Render collected Rows as a header line plus pipe-delimited values."""
+    if not rows:
+        return ""
+    lines = [" | ".join(rows[0].asDict().keys())]
+    for r in rows:
+        lines.append(" | ".join(
+            f"{v:.4f}" if isinstance(v, float) else str(v)
+            for v in r.asDict().values()
+        ))
+    return "\n".join(lines)
+
+
 # Initialize Spark Session with optimized configurations for large datasets
 spark = SparkSession.builder \
     .appName("VVD_Campaign_Performance_Pipeline") \
     .config("spark.sql.adaptive.enabled", "true") \
     .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
     .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+    .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "134217728") \
+    .config("spark.sql.adaptive.coalescePartitions.initialPartitionNum", "4096") \
+    .config("spark.sql.adaptive.skewJoin.skewedPartitionFactor", "5") \
+    .config("spark.sql.adaptive.skewJoin.skewedPartitionThresholdInBytes", "268435456") \
     .config("spark.sql.files.maxPartitionBytes", "134217728") \
     .config("spark.sql.shuffle.partitions", "400") \
+    .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
+    .config("spark.memory.fraction", "0.6") \
+    .config("spark.sql.parquet.compression.codec", "snappy") \
     .getOrCreate()
 
+# Session conf entries are copied into each query's Hadoop conf, so this
+# reaches the Parquet writer even when getOrCreate() reuses a SparkContext
+spark.conf.set("parquet.block.size", "134217728")
+
 # Set up date parameters
-analysis_end_date = current_date()
-analysis_start_date = date_sub(analysis_end_date, 548)  # 18 months
+# Computed once on the driver so the filter is a constant DateType literal
+# that Parquet can prune row groups against
+analysis_end_date = datetime.date.today()
+analysis_start_date = analysis_end_date - datetime.timedelta(days=548)  # 18 months
 
-# Load main tables with proper schema definition
-# Define schema for better performance
+# Schema of the raw CSV, used by the one-time Parquet conversion below
 campaign_schema = StructType([
     StructField("TACTIC_ID", StringType(), True),
     StructField("CLIENT_ID", StringType(), True),
@@ -44,24 +71,64 @@ campaign_schema = StructType([
     StructField("REVENUE", DoubleType(), True)
 ])
 
+deployments_csv_path = "path/to/vvd_campaign_deployments.csv"
+deployments_parquet_path = "path/to/vvd_deployments.parquet"
+
+# One-time conversion of the raw CSV to Parquet partitioned by month.
+# CSV cannot push down predicates or projections.
+# Set this to True for the first run; the read below fails with
+# "Path does not exist" until the Parquet copy has been written.
+# Set it back to False once the copy exists.
+convert_csv_to_parquet = False
+
+if convert_csv_to_parquet:
+    spark.read \
+        .option("header", "true") \
+        .schema(campaign_schema) \
+        .csv(deployments_csv_path) \
+        .withColumn("year_month", date_format("DEPLOYMENT_DATE", "yyyy-MM")) \
+        .write.mode("overwrite") \
+        .partitionBy("year_month") \
+        .parquet(deployments_parquet_path)
+
 # Read campaign deployments data
+# - The year_month filter prunes partition directories.
+# - The DEPLOYMENT_DATE filter is pushed down to Parquet row-group statistics.
+# - Only the 12 columns used downstream are read and cached.
+# - Repartitioning by CLIENT_ID lets the client windows and
+#   df_client_engagement reuse the cached partitioning. AQE can still
+#   coalesce it, but client skew is not split.
+# - PySpark's MEMORY_AND_DISK maps to the JVM's serialized MEMORY_AND_DISK_SER,
+#   so cached blocks stay compact and spill to disk instead of failing.
 df_deployments = spark.read \
-    .option("header", "true") \
-    .schema(campaign_schema) \
-    .csv("path/to/vvd_campaign_deployments.csv") \
-    .filter(col("DEPLOYMENT_DATE").between(analysis_start_date, analysis_end_date))
-
-# Cache the main dataframe for reuse
-df_deployments.cache()
+    .parquet(deployments_parquet_path) \
+    .filter(col("year_month").between(
+        analysis_start_date.strftime("%Y-%m"), analysis_end_date.strftime("%Y-%m")
+    )) \
+    .filter(col("DEPLOYMENT_DATE").between(lit(analysis_start_date), lit(analysis_end_date))) \
+    .select(
+        "TACTIC_ID", "CLIENT_ID", "CAMPAIGN_ID", "CAMPAIGN_NAME",
+        "DEPLOYMENT_DATE", "CHANNEL", "OFFER_TYPE",
+        "RESPONSE_FLAG", "RESPONSE_DATE",
+        "CONVERSION_FLAG", "CONVERSION_DATE", "REVENUE"
+    ) \
+    .repartition("CLIENT_ID") \
+    .persist(StorageLevel.MEMORY_AND_DISK)
 
 # 1. Contact Frequency Analysis
 # Calculate contact frequency per client
-window_client = Window.partitionBy("CLIENT_ID").orderBy("DEPLOYMENT_DATE")
-window_client_30d = Window.partitionBy("CLIENT_ID").orderBy("DEPLOYMENT_DATE").rangeBetween(-30*86400, 0)
-window_client_60d = Window.partitionBy("CLIENT_ID").orderBy("DEPLOYMENT_DATE").rangeBetween(-60*86400, 0)
-window_client_90d = Window.partitionBy("CLIENT_ID").orderBy("DEPLOYMENT_DATE").rangeBetween(-90*86400, 0)
+# Range frames are expressed in the units of the ORDER BY column, so order
+# by a day number and use day offsets. All windows share the same partition
+# and order spec, so Spark evaluates them over a single sort and exchange.
+window_client = Window.partitionBy("CLIENT_ID").orderBy("dep_day")
+window_client_30d = Window.partitionBy("CLIENT_ID").orderBy("dep_day").rangeBetween(-30, 0)
+window_client_60d = Window.partitionBy("CLIENT_ID").orderBy("dep_day").rangeBetween(-60, 0)
+window_client_90d = Window.partitionBy("CLIENT_ID").orderBy("dep_day").rangeBetween(-90, 0)
 
 df_contact_frequency = df_deployments.withColumn(
+    "dep_day",
+    datediff(col("DEPLOYMENT_DATE"), lit("1970-01-01"))
+).withColumn(
     "days_since_last_contact", 
     datediff(col("DEPLOYMENT_DATE"), lag("DEPLOYMENT_DATE", 1).over(window_client))
 ).withColumn(
@@ -78,6 +145,10 @@ df_contact_frequency = df_deployments.withColumn(
     count("TACTIC_ID").over(window_client_90d) - 1
 )
 
+# Relative standard deviation for HyperLogLog++ distinct counts
+# (0.05 is cheaper, 0.01 is more precise)
+distinct_count_rsd = 0.02
+
 # 2. Campaign Performance Metrics
 # Aggregate at campaign level
 df_campaign_performance = df_deployments.groupBy(
@@ -87,7 +158,7 @@ df_campaign_performance = df_deployments.groupBy(
     "OFFER_TYPE"
 ).agg(
     count("TACTIC_ID").alias("total_deployments"),
-    countDistinct("CLIENT_ID").alias("unique_clients"),
+    approx_count_distinct("CLIENT_ID", distinct_count_rsd).alias("unique_clients"),
     sum("RESPONSE_FLAG").alias("total_responses"),
     sum("CONVERSION_FLAG").alias("total_conversions"),
     sum("REVENUE").alias("total_revenue"),
@@ -106,18 +177,62 @@ df_campaign_performance = df_deployments.groupBy(
     avg(when(col("CONVERSION_FLAG") == 1, 
         datediff(col("CONVERSION_DATE"), col("DEPLOYMENT_DATE"))
     )).alias("avg_days_to_conversion")
-)
+).persist(StorageLevel.MEMORY_AND_DISK)  # Written and then ranked for the summary
 
 # 3. Contact Frequency Impact Analysis
-# Join frequency data with response/conversion
-df_frequency_impact = df_contact_frequency.groupBy(
+# Single aggregation pass shared by the frequency impact, optimal frequency
+# and monthly trend outputs; each is a small rollup of this result.
+# Non-null counts are kept per column so the rollups reproduce avg() exactly,
+# and is_new_client marks each client's first contact per month and channel
+# so unique clients can be summed (the window reuses the CLIENT_ID partitioning).
+window_client_month_channel = Window.partitionBy("CLIENT_ID", "year_month", "CHANNEL").orderBy("dep_day")
+
+df_frequency_base = df_contact_frequency.withColumn(
+    "year_month",
+    date_format("DEPLOYMENT_DATE", "yyyy-MM")
+).withColumn(
+    "is_new_client",
+    when(
+        col("CLIENT_ID").isNotNull() &
+        (row_number().over(window_client_month_channel) == 1), 1
+    ).otherwise(0)
+).groupBy("year_month", "CHANNEL", "contacts_last_30d").agg(
+    count("TACTIC_ID").alias("n"),
+    sum("is_new_client").alias("new_clients"),
+    count("RESPONSE_FLAG").alias("n_r"),
+    sum("RESPONSE_FLAG").alias("r"),
+    count("CONVERSION_FLAG").alias("n_c"),
+    sum("CONVERSION_FLAG").alias("c"),
+    count("REVENUE").alias("n_rev"),
+    sum("REVENUE").alias("rev"),
+    sum(col("REVENUE") * col("REVENUE")).alias("rev_sq")
+).persist(StorageLevel.MEMORY_AND_DISK)
+
+frequency_base_sums = [
+    sum(c).alias(c)
+    for c in ("n", "new_clients", "n_r", "r", "n_c", "c", "n_rev", "rev", "rev_sq")
+]
+
+# Averages and sample standard deviation from the summed moments, matching
+# avg() and stddev(): NULL when a rollup has too few non-null values, which
+# also avoids DIVIDE_BY_ZERO under ANSI mode
+response_avg = when(col("n_r") > 0, col("r") / col("n_r"))
+conversion_avg = when(col("n_c") > 0, col("c") / col("n_c"))
+revenue_avg = when(col("n_rev") > 0, col("rev") / col("n_rev"))
+revenue_stddev = when(col("n_rev") > 1, sqrt(greatest(
+    lit(0.0),
+    (col("rev_sq") - col("rev") * col("rev") / col("n_rev")) / (col("n_rev") - 1)
+)))
+
+df_frequency_impact = df_frequency_base.groupBy(
     "contacts_last_30d"
-).agg(
-    count("TACTIC_ID").alias("deployments_count"),
-    avg("RESPONSE_FLAG").alias("avg_response_rate"),
-    avg("CONVERSION_FLAG").alias("avg_conversion_rate"),
-    avg("REVENUE").alias("avg_revenue"),
-    stddev("REVENUE").alias("revenue_stddev")
+).agg(*frequency_base_sums).select(
+    "contacts_last_30d",
+    col("n").alias("deployments_count"),
+    response_avg.alias("avg_response_rate"),
+    conversion_avg.alias("avg_conversion_rate"),
+    revenue_avg.alias("avg_revenue"),
+    revenue_stddev.alias("revenue_stddev")
 ).orderBy("contacts_last_30d")
 
 # 4. Client Segmentation by Engagement
@@ -133,83 +248,110 @@ df_client_engagement = df_deployments.groupBy("CLIENT_ID").agg(
     # Calculate engagement metrics
     (sum("RESPONSE_FLAG") / count("TACTIC_ID")).alias("response_rate"),
     (sum("CONVERSION_FLAG") / count("TACTIC_ID")).alias("conversion_rate")
-).withColumn(
-    "days_since_last_contact",
-    datediff(current_date(), col("last_contact_date"))
-).withColumn(
-    "customer_lifetime_days",
-    datediff(col("last_contact_date"), col("first_contact_date"))
-).withColumn(
-    "engagement_score",
-    col("response_rate") * 0.3 + 
-    col("conversion_rate") * 0.5 + 
-    (col("total_revenue") / col("total_contacts")) * 0.2
+).select(
+    # Derived metrics in one projection above the aggregate
+    "*",
+    datediff(current_date(), col("last_contact_date")).alias("days_since_last_contact"),
+    datediff(col("last_contact_date"), col("first_contact_date")).alias("customer_lifetime_days"),
+    (
+        col("response_rate") * 0.3 + 
+        col("conversion_rate") * 0.5 + 
+        (col("total_revenue") / col("total_contacts")) * 0.2
+    ).alias("engagement_score")
 )
 
 # 5. Optimal Contact Frequency Analysis
 # Find optimal frequency by channel
-df_optimal_frequency = df_contact_frequency.join(
-    df_deployments.select("TACTIC_ID", "CHANNEL", "RESPONSE_FLAG", "CONVERSION_FLAG", "REVENUE"),
-    on="TACTIC_ID"
-).groupBy(
+# Rolled up from df_frequency_base
+df_optimal_frequency = df_frequency_base.groupBy(
     "CHANNEL",
     "contacts_last_30d"
-).agg(
-    count("TACTIC_ID").alias("sample_size"),
-    avg("RESPONSE_FLAG").alias("response_rate"),
-    avg("CONVERSION_FLAG").alias("conversion_rate"),
-    avg("REVENUE").alias("avg_revenue"),
-    stddev("REVENUE").alias("revenue_std")
+).agg(*frequency_base_sums).select(
+    "CHANNEL",
+    "contacts_last_30d",
+    col("n").alias("sample_size"),
+    response_avg.alias("response_rate"),
+    conversion_avg.alias("conversion_rate"),
+    revenue_avg.alias("avg_revenue"),
+    revenue_stddev.alias("revenue_std")
 ).filter(col("sample_size") >= 100)  # Ensure statistical significance
 
 # 6. Time Series Analysis
-# Monthly performance trends
-df_monthly_trends = df_deployments.withColumn(
+# Monthly performance trends, rolled up from df_frequency_base
+df_monthly_trends = df_frequency_base.groupBy(
     "year_month",
-    date_format("DEPLOYMENT_DATE", "yyyy-MM")
-).groupBy("year_month", "CHANNEL").agg(
-    count("TACTIC_ID").alias("deployments"),
-    countDistinct("CLIENT_ID").alias("unique_clients"),
-    avg("RESPONSE_FLAG").alias("response_rate"),
-    avg("CONVERSION_FLAG").alias("conversion_rate"),
-    sum("REVENUE").alias("total_revenue")
+    "CHANNEL"
+).agg(*frequency_base_sums).select(
+    "year_month",
+    "CHANNEL",
+    col("n").alias("deployments"),
+    col("new_clients").alias("unique_clients"),
+    response_avg.alias("response_rate"),
+    conversion_avg.alias("conversion_rate"),
+    col("rev").alias("total_revenue")
 ).orderBy("year_month", "CHANNEL")
 
 # 7. Create summary statistics
+# Compute all summary metrics in a single Spark job and reuse the Row
+stats = df_deployments.agg(
+    count(lit(1)).alias("n"),
+    approx_count_distinct("CLIENT_ID", distinct_count_rsd).alias("uc"),
+    approx_count_distinct("CAMPAIGN_ID", distinct_count_rsd).alias("uk"),
+    (avg("RESPONSE_FLAG") * 100).alias("rr"),
+    (avg("CONVERSION_FLAG") * 100).alias("cr"),
+    sum("REVENUE").alias("rev")
+).first().asDict()
+
 print("VVD Campaign Performance Analysis Summary")
 print("=" * 50)
 print(f"Analysis Period: 18 months")
-print(f"Total Deployments: {df_deployments.count():,}")
-print(f"Unique Clients: {df_deployments.select('CLIENT_ID').distinct().count():,}")
-print(f"Total Campaigns: {df_deployments.select('CAMPAIGN_ID').distinct().count():,}")
+print(f"Total Deployments: {stats['n']:,}")
+print(f"Unique Clients: {stats['uc']:,}")
+print(f"Total Campaigns: {stats['uk']:,}")
 
 # Save results
 output_path = "path/to/output/"
 
 # Save all analytical results
-df_campaign_performance.coalesce(1).write.mode("overwrite").parquet(f"{output_path}/campaign_performance")
-df_frequency_impact.coalesce(1).write.mode("overwrite").parquet(f"{output_path}/frequency_impact")
+df_campaign_performance.write.mode("overwrite").parquet(f"{output_path}/campaign_performance")
+df_frequency_impact.write.mode("overwrite").parquet(f"{output_path}/frequency_impact")
 df_client_engagement.write.mode("overwrite").parquet(f"{output_path}/client_engagement")
-df_optimal_frequency.coalesce(1).write.mode("overwrite").parquet(f"{output_path}/optimal_frequency")
-df_monthly_trends.coalesce(1).write.mode("overwrite").parquet(f"{output_path}/monthly_trends")
+df_optimal_frequency.write.mode("overwrite").parquet(f"{output_path}/optimal_frequency")
+df_monthly_trends.write.mode("overwrite").parquet(f"{output_path}/monthly_trends")
 
 # Create executive summary
+# orderBy + limit plans a TakeOrderedAndProject, and collect() returns the
+# few Rows directly without a pandas conversion
+top_campaigns = df_campaign_performance.orderBy(
+    col("conversion_rate").desc()
+).limit(5).collect()
+top_frequencies = df_optimal_frequency.orderBy(
+    col("avg_revenue").desc()
+).limit(10).collect()
+
+# Release intermediates as soon as their last consumer has run
+df_campaign_performance.unpersist(blocking=False)
+df_frequency_base.unpersist(blocking=False)
+
+top_campaigns_text = format_rows(top_campaigns)
+top_frequencies_text = format_rows(top_frequencies)
+
 executive_summary = f"""
 VVD Campaign Performance Executive Summary
 Generated: {datetime.datetime.now()}
 
 Key Metrics:
-- Total Deployments: {df_deployments.count():,}
-- Unique Clients: {df_deployments.select('CLIENT_ID').distinct().count():,}
-- Overall Response Rate: {df_deployments.agg(avg('RESPONSE_FLAG') * 100).collect()[0][0]:.2f}%
-- Overall Conversion Rate: {df_deployments.agg(avg('CONVERSION_FLAG') * 100).collect()[0][0]:.2f}%
-- Total Revenue: ${df_deployments.agg(sum('REVENUE')).collect()[0][0]:,.2f}
+- Total Deployments: {stats['n']:,}
+- Unique Clients: {stats['uc']:,}
+- Overall Response Rate: {stats['rr']:.2f}%
+- Overall Conversion Rate: {stats['cr']:.2f}%
+- Total Revenue: ${stats['rev']:,.2f}
 
 Top Performing Campaigns:
-{df_campaign_performance.orderBy(col("conversion_rate").desc()).limit(5).toPandas().to_string()}
+{top_campaigns_text}
 
 Optimal Contact Frequency:
-{df_optimal_frequency.orderBy(col("avg_revenue").desc()).limit(10).toPandas().to_string()}
+{top_frequencies_text}
 """
 
 # Save executive summary